@@ -0,0 +1,339 @@
+# -*- coding:utf-8 -*-
+"""
+System statistics for the e-Paper system monitor
+Load, memory, CPU temperature, uptime, disk usage and SMART disk statistics
+"""
+import os
+import json
+import select
+import asyncio
+import time
+import logging
+from array import array
+
+logger = logging.getLogger(__name__)
+
+DEVICE = '/dev/sda'
+DEVICE_STAT = f'/sys/block/{os.path.basename(DEVICE)}/stat'
+
+# Partitions shown on the display in addition to the root filesystem
+DISK_DEVICES = ['/dev/sda1', '/dev/sdb1']
+
+# SMART attributes read from smartctl
+SMART_ATTRS = {
+    'Load_Cycle_Count',
+    'Start_Stop_Count',
+    'Reallocated_Sector_Ct',
+    'Current_Pending_Sector',
+    'Offline_Uncorrectable',
+    'UDMA_CRC_Error_Count',
+}
+
+# SMART counters change a few times per hour at most; re-run smartctl this often
+SMART_REFRESH_SEC = 900
+
+# In-memory rolling 24-hour window for SMART stats: one slot per hour (0-23),
+# bit N of history_mask set once hour N has been filled
+load_cycle_history = array('q', [0] * 24)
+start_stop_history = array('q', [0] * 24)
+history_mask = 0
+
+# What the current hour's bucket held before its first overwrite this hour
+hour_baseline = {"hour": None, "load": 0, "start": 0, "day_old": False}
+
+# Files read every tick; kept open and re-read with pread once main() starts
+PINNED_FILES = [
+    '/proc/loadavg',
+    '/proc/meminfo',
+    '/proc/uptime',
+    '/sys/class/thermal/thermal_zone0/temp',
+    DEVICE_STAT,
+]
+_pinned_fds = {}
+
+# Display key -> mount point, refreshed from /proc/mounts when the mount table changes
+_disk_mounts = {}
+_mounts_poll = None
+
+# Last smartctl result and the monotonic time it was taken
+_smart_cache = {"ts": None, "value": None, "io": None}
+
+def open_pinned_files():
+    """Open the per-tick /proc and /sys files once and keep them for the process lifetime"""
+    for path in PINNED_FILES:
+        try:
+            _pinned_fds[path] = os.open(path, os.O_RDONLY)
+        except OSError as e:
+            logger.error(f"Error opening {path}: {e}")
+
+
+def close_pinned_files():
+    """Close the file descriptors opened by open_pinned_files()"""
+    while _pinned_fds:
+        _, fd = _pinned_fds.popitem()
+        os.close(fd)
+
+
+def _read_small(path, size=256):
+    """Read a small /proc or /sys file as raw bytes, bypassing Python's text IO layer"""
+    fd = _pinned_fds.get(path)
+    if fd is not None:
+        # Kernel regenerates the contents on every read from offset 0
+        return os.pread(fd, size, 0)
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.read(fd, size)
+    finally:
+        os.close(fd)
+
+
+def get_system_load():
+    """Read system load averages from /proc/loadavg"""
+    try:
+        parts = _read_small('/proc/loadavg').split(None, 3)
+        return [float(parts[0]), float(parts[1]), float(parts[2])]
+    except Exception as e:
+        logger.error(f"Error reading load: {e}")
+        return [0.0, 0.0, 0.0]
+
+
+def get_memory_usage():
+    """Get memory usage percentage"""
+    try:
+        data = _read_small('/proc/meminfo', 4096)
+        # Pull the two values straight out of the raw bytes (kB)
+        i = data.index(b'MemTotal:') + 9
+        mem_total = int(data[i:data.index(b'\n', i)].split()[0])
+        i = data.index(b'MemAvailable:') + 13
+        mem_available = int(data[i:data.index(b'\n', i)].split()[0])
+        mem_used_percent = ((mem_total - mem_available) / mem_total) * 100
+        return mem_used_percent
+    except Exception as e:
+        logger.error(f"Error reading memory: {e}")
+        return 0.0
+
+
+def get_cpu_temperature():
+    """Get CPU temperature in Celsius"""
+    try:
+        temp = int(_read_small('/sys/class/thermal/thermal_zone0/temp')) / 1000.0
+        return temp
+    except Exception as e:
+        logger.error(f"Error reading CPU temp: {e}")
+        return 0.0
+
+
+def get_uptime():
+    """Get system uptime as days and hours"""
+    try:
+        uptime_seconds = float(_read_small('/proc/uptime').split(None, 1)[0])
+        days = int(uptime_seconds // 86400)
+        hours = int((uptime_seconds % 86400) // 3600)
+        return days, hours
+    except Exception as e:
+        logger.error(f"Error reading uptime: {e}")
+        return 0, 0
+
+
+def _mounts_changed():
+    """True on first call and whenever the kernel mount table has changed since the last call"""
+    global _mounts_poll
+    if _mounts_poll is None:
+        try:
+            _mounts_poll = select.poll()
+            _mounts_poll.register(os.open('/proc/mounts', os.O_RDONLY), select.POLLPRI)
+        except OSError as e:
+            logger.error(f"Error watching mounts: {e}")
+            _mounts_poll = None
+        return True
+    # /proc/mounts signals POLLPRI|POLLERR once for each mount or unmount
+    return bool(_mounts_poll.poll(0))
+
+
+def get_disk_mounts():
+    """
+    Map each displayed disk ('/', '/dev/sda1', '/dev/sdb1') to its mount point
+    Re-read from /proc/mounts only when something has been mounted or unmounted
+    """
+    changed = _mounts_changed()
+    if _disk_mounts and not changed:
+        return _disk_mounts
+
+    _disk_mounts.clear()
+    _disk_mounts['/'] = '/'
+    try:
+        with open('/proc/mounts', 'r') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0] in DISK_DEVICES:
+                    _disk_mounts.setdefault(parts[0], parts[1])
+    except Exception as e:
+        logger.error(f"Error reading mounts: {e}")
+    return _disk_mounts
+
+
+def get_disk_usage():
+    """Get disk usage percentage for main partitions"""
+    partitions = {}
+    for name, mount in get_disk_mounts().items():
+        # An unmounted mountpoint is just a directory on / - don't report its usage
+        if not os.path.ismount(mount):
+            continue
+        try:
+            s = os.statvfs(mount)
+            # Same rounding as df: used / (used + available to non-root), rounded up
+            used = s.f_blocks - s.f_bfree
+            total = used + s.f_bavail
+            if total > 0:
+                partitions[name] = -(-used * 100 // total)
+        except Exception as e:
+            logger.error(f"Error reading disk usage for {mount}: {e}")
+
+    return partitions
+
+
+async def get_smart_stats(device=DEVICE):
+    """
+    Get SMART statistics from device using smartctl
+    Returns dict with: Load_Cycle_Count, Start_Stop_Count,
+    Reallocated_Sector_Ct, Current_Pending_Sector,
+    Offline_Uncorrectable, UDMA_CRC_Error_Count
+    """
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            # --nocheck=standby: don't spin up a sleeping drive just to read counters
+            'sudo', 'smartctl', '--json', '-A', '--nocheck=standby', device,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=5)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            logger.error("smartctl timeout")
+            return None
+        stdout = stdout.decode()
+
+        if proc.returncode not in [0, 4]:  # 4 means SMART warning but data is valid
+            if 'STANDBY' in stdout:
+                logger.debug("smartctl skipped: drive in standby")
+            else:
+                logger.error(f"smartctl failed: {stdout or stderr.decode()}")
+            return None
+
+        stats = {}
+        doc = json.loads(stdout)
+        for entry in doc.get('ata_smart_attributes', {}).get('table', []):
+            name = entry.get('name')
+            if name in SMART_ATTRS:
+                stats[name] = int(entry['raw']['value'])
+        logger.debug(f"Load_Cycle_Count: {stats.get('Load_Cycle_Count')}, "
+                     f"Start_Stop_Count: {stats.get('Start_Stop_Count')}")
+
+        return stats
+    except Exception as e:
+        logger.error(f"Error reading SMART: {e}")
+        return None
+
+
+def get_disk_io_counts():
+    """Get (reads completed, writes completed) for DEVICE from sysfs, or None"""
+    try:
+        fields = _read_small(DEVICE_STAT).split()
+        return int(fields[0]), int(fields[4])
+    except Exception as e:
+        logger.error(f"Error reading disk stats: {e}")
+        return None
+
+
+async def get_smart_stats_cached():
+    """
+    Return SMART statistics, re-running smartctl at most every SMART_REFRESH_SEC
+    and only if the disk has done any I/O since the last read
+    Returns (stats, current) where current is True if stats are known to match the disk
+    right now: just read, or unchanged because the disk has done no I/O since the last read
+    """
+    now = time.monotonic()
+    if _smart_cache["ts"] is not None and now - _smart_cache["ts"] < SMART_REFRESH_SEC:
+        return _smart_cache["value"], False
+
+    io = get_disk_io_counts()
+    if _smart_cache["ts"] is not None and io is not None and io == _smart_cache["io"]:
+        # No reads or writes completed, so the SMART counters can't have moved
+        return _smart_cache["value"], _smart_cache["value"] is not None
+
+    stats = await get_smart_stats()
+
+    # Stamp failed reads too (drive in standby, smartctl missing, empty table) so the
+    # retry waits for SMART_REFRESH_SEC and new disk I/O instead of forking every tick
+    _smart_cache["ts"] = now
+    _smart_cache["io"] = io
+    if not stats:
+        # Keep showing the last good values
+        return _smart_cache["value"], False
+
+    _smart_cache["value"] = stats
+    return stats, True
+
+
+def update_smart_history(stats, hour):
+    """Add current SMART stats to the hourly bucket (0-23)"""
+    global history_mask
+    if stats:
+        if hour_baseline["hour"] != hour:
+            # First write this hour: keep the bucket's 24h-old reading before overwriting it,
+            # or this first reading if the bucket was empty
+            day_old = bool(history_mask & (1 << hour))
+            hour_baseline["hour"] = hour
+            hour_baseline["day_old"] = day_old
+            if day_old:
+                hour_baseline["load"] = load_cycle_history[hour]
+                hour_baseline["start"] = start_stop_history[hour]
+            else:
+                hour_baseline["load"] = stats.get('Load_Cycle_Count', 0)
+                hour_baseline["start"] = stats.get('Start_Stop_Count', 0)
+
+        load_cycle_history[hour] = stats.get('Load_Cycle_Count', 0)
+        start_stop_history[hour] = stats.get('Start_Stop_Count', 0)
+        history_mask |= 1 << hour
+
+
+def calculate_deltas(current_stats, current_hour):
+    """Calculate delta using 24hr old data, or oldest available if not present"""
+    if not current_stats or not history_mask:
+        return None, None
+
+    try:
+        written_this_hour = hour_baseline["hour"] == current_hour
+        others = history_mask & ~(1 << current_hour)
+        if written_this_hour and hour_baseline["day_old"]:
+            # Current bucket already overwritten; use the 24h-old reading it held
+            oldest = "24h baseline"
+            prev_load, prev_start = hour_baseline["load"], hour_baseline["start"]
+        elif not written_this_hour and history_mask & (1 << current_hour):
+            # Current bucket not yet overwritten this hour, so it is still 24 hours old
+            oldest = current_hour
+            prev_load, prev_start = load_cycle_history[oldest], start_stop_history[oldest]
+        elif others:
+            # Rotate so bit k is hour (current_hour + 1 + k): lowest set bit is the oldest
+            rotated = ((others >> (current_hour + 1)) |
+                       (others << (23 - current_hour))) & 0xFFFFFF
+            oldest = (current_hour + (rotated & -rotated).bit_length()) % 24
+            prev_load, prev_start = load_cycle_history[oldest], start_stop_history[oldest]
+        else:
+            # Only this hour has data: compare with its first reading
+            oldest = "first reading this hour"
+            prev_load, prev_start = hour_baseline["load"], hour_baseline["start"]
+
+        load_delta = current_stats.get('Load_Cycle_Count', 0) - prev_load
+        start_delta = current_stats.get('Start_Stop_Count', 0) - prev_start
+
+        logger.debug(f"Delta calculation: current_hour={current_hour}, oldest={oldest}, "
+                     f"load_delta={load_delta}, start_delta={start_delta}")
+
+        return load_delta, start_delta
+    except Exception as e:
+        logger.error(f"Error calculating deltas: {e}")
+        return None, None
@@ -7,11 +7,8 @@ Updates every minute
 """
 import sys
 import os
-import json
-import subprocess
+import asyncio
 import time
-import re
-from datetime import datetime, timedelta
 
 # Setup paths
 epd_base = os.path.join(os.path.dirname(os.path.realpath(__file__)), 
@@ -23,186 +20,166 @@ if os.path.exists(libdir):
 
 import logging
 from waveshare_epd import epd2in13_V4, epdconfig
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+from stats import (
+    get_system_load, get_memory_usage, get_cpu_temperature, get_uptime, get_disk_usage,
+    get_smart_stats_cached, update_smart_history, calculate_deltas,
+    open_pinned_files, close_pinned_files,
+)
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-DEVICE = '/dev/sda'
+# Every Nth partial update sends the whole frame instead of only the changed window
+WINDOW_FULL_EVERY = 10
 
-# In-memory rolling 24-hour window for SMART stats (hourly buckets)
-smart_stats_history = {}
+# Send a partial-update window as one SPI transfer (False: one transfer per row)
+FAST_SPI = True
 
-def get_system_load():
-    """Read system load averages from /proc/loadavg"""
-    try:
-        with open('/proc/loadavg', 'r') as f:
-            loads = f.read().split()[:3]
-            return [float(x) for x in loads]
-    except Exception as e:
-        logger.error(f"Error reading load: {e}")
-        return [0.0, 0.0, 0.0]
+# Force a full refresh once partial updates have erased this many black pixels
+EINK_PARTIAL_ERASURE_LIMIT = 5000
 
+# Static screen chrome, built by build_template() at startup
+_template = None
 
-def get_memory_usage():
-    """Get memory usage percentage"""
-    try:
-        with open('/proc/meminfo', 'r') as f:
-            lines = f.readlines()
-            mem_total = int([l for l in lines if l.startswith('MemTotal:')][0].split()[1])
-            mem_available = int([l for l in lines if l.startswith('MemAvailable:')][0].split()[1])
-            mem_used_percent = ((mem_total - mem_available) / mem_total) * 100
-            return mem_used_percent
-    except Exception as e:
-        logger.error(f"Error reading memory: {e}")
-        return 0.0
+# Framebuffer last sent to the panel, and partial updates since startup
+_prev_buffer = None
+_partial_count = 0
 
+# Black pixel count of the last frame, and erasures accumulated since the last full refresh
+_prev_black_count = None
+_erased_pixels = 0
 
-def get_cpu_temperature():
-    """Get CPU temperature in Celsius"""
-    try:
-        with open('/sys/class/thermal/thermal_zone0/temp', 'r') as f:
-            temp = int(f.read().strip()) / 1000.0
-            return temp
-    except Exception as e:
-        logger.error(f"Error reading CPU temp: {e}")
-        return 0.0
+# Persistent frame, updated field by field, and the text currently drawn in each field
+_canvas = None
+_last_text = {}
 
 
-def get_uptime():
-    """Get system uptime as days and hours"""
-    try:
-        with open('/proc/uptime', 'r') as f:
-            uptime_seconds = float(f.read().split()[0])
-            days = int(uptime_seconds // 86400)
-            hours = int((uptime_seconds % 86400) // 3600)
-            return days, hours
-    except Exception as e:
-        logger.error(f"Error reading uptime: {e}")
-        return 0, 0
+def build_template(epd):
+    """Pre-render the static parts of the screen once; render_display copies this each tick"""
+    global _template
+    _template = Image.new('1', (epd.height, epd.width), 255)
+    draw = ImageDraw.Draw(_template)
 
+    # Box around time and date
+    draw.rectangle([(0, 0), (100, 59)], outline=0, width=1)
 
-def get_disk_usage():
-    """Get disk usage percentage for main partitions"""
-    partitions = {}
-    try:
-        # Read from df command for accuracy
-        result = subprocess.run(
-            ['df', '-h'],
-            capture_output=True,
-            text=True,
-            timeout=5
-        )
-
-        for line in result.stdout.split('\n')[1:]:  # Skip header
-            if line.strip():
-                parts = line.split()
-                if len(parts) >= 6:
-                    device = parts[0]
-                    mount = parts[5]
-                    used_percent = parts[4].rstrip('%')
-                    try:
-                        # Store by device name for /dev/sdX1, or by mount point for /
-                        if device in ['/dev/sda1', '/dev/sdb1']:
-                            partitions[device] = int(used_percent)
-                        elif mount == '/':
-                            partitions['/'] = int(used_percent)
-                    except ValueError:
-                        pass
-
-        return partitions
-    except Exception as e:
-        logger.error(f"Error reading disk usage: {e}")
-        return {}
+
+def pack_buffer(epd, image):
+    """
+    Convert the landscape canvas into the panel's portrait framebuffer
+    Equivalent to epd.getbuffer(image.rotate(180)) - the 180 degree flip plus the driver's
+    90 degree rotation - done as one C transpose and a raw 1-bit pack
+    """
+    assert image.size == (epd.height, epd.width)
+    return bytearray(image.transpose(Image.ROTATE_270).tobytes('raw'))
 
 
-def get_smart_stats(device=DEVICE):
+def _changed_window(epd, buffer, prev_buffer):
     """
-    Get SMART statistics from device using smartctl
-    Returns dict with: Load_Cycle_Count, Start_Stop_Count,
-    Reallocated_Sector_Ct, Current_Pending_Sector,
-    Offline_Uncorrectable, UDMA_CRC_Error_Count
+    Find the region of panel RAM that differs between two framebuffers
+    Returns (x0, y0, x1, y1) inclusive, x in bytes and y in rows, or None if identical
     """
-    try:
-        result = subprocess.run(
-            ['sudo', 'smartctl', '-A', device],
-            capture_output=True,
-            text=True,
-            timeout=5
-        )
-
-        if result.returncode not in [0, 4]:  # 4 means SMART warning but data is valid
-            logger.error(f"smartctl failed: {result.stderr}")
-            return None
-
-        stats = {}
-        # Parse SMART attributes
-        for line in result.stdout.split('\n'):
-            line = line.strip()
-            if 'Load_Cycle_Count' in line:
-                stats['Load_Cycle_Count'] = int(line.split()[9])
-                logger.debug(f"Load_Cycle_Count: {stats['Load_Cycle_Count']}")
-            elif 'Start_Stop_Count' in line:
-                stats['Start_Stop_Count'] = int(line.split()[9])
-                logger.debug(f"Start_Stop_Count: {stats['Start_Stop_Count']}")
-            elif 'Reallocated_Sector_Ct' in line:
-                stats['Reallocated_Sector_Ct'] = int(line.split()[9])
-            elif 'Current_Pending_Sector' in line:
-                stats['Current_Pending_Sector'] = int(line.split()[9])
-            elif 'Offline_Uncorrectable' in line:
-                stats['Offline_Uncorrectable'] = int(line.split()[9])
-            elif 'UDMA_CRC_Error_Count' in line:
-                stats['UDMA_CRC_Error_Count'] = int(line.split()[9])
-
-        return stats
-    except subprocess.TimeoutExpired:
-        logger.error("smartctl timeout")
-        return None
-    except Exception as e:
-        logger.error(f"Error reading SMART: {e}")
+    # Buffer rows are padded to whole bytes
+    line_bytes = (epd.width + 7) // 8
+    size = (line_bytes * 8, epd.height)
+    bbox = ImageChops.logical_xor(
+        Image.frombytes('1', size, bytes(buffer)),
+        Image.frombytes('1', size, bytes(prev_buffer))
+    ).getbbox()
+    if bbox is None:
         return None
 
+    x0, y0, x1, y1 = bbox
+    return x0 >> 3, y0, (x1 - 1) >> 3, y1 - 1
 
-def update_smart_history(stats, hour):
-    """Add current SMART stats to the hourly bucket (0-23)"""
-    if stats:
-        smart_stats_history[hour] = stats
 
+def _display_window(epd, buffer, x0, y0, x1, y1):
+    """Partial update that only sends panel RAM bytes x0..x1 of rows y0..y1"""
+    line_bytes = (epd.width + 7) // 8
 
-def calculate_deltas(current_stats, current_hour):
-    """Calculate delta using 24hr old data, or oldest available if not present"""
-    if not current_stats or not smart_stats_history:
-        return None, None
+    # Same controller setup as epd2in13_V4.displayPartial, with a narrowed RAM window
+    epdconfig.digital_write(epd.reset_pin, 0)
+    epdconfig.delay_ms(1)
+    epdconfig.digital_write(epd.reset_pin, 1)
 
-    try:
-        # Find oldest hour by checking backwards from current hour (skip current hour)
-        oldest_hour = None
-        max_hours_back = 24
-        for i in range(1, max_hours_back + 1):
-            check_hour = (current_hour - i) % 24
-            if check_hour in smart_stats_history:
-                oldest_hour = check_hour
-                # Don't break - keep searching to find the truly oldest data
+    epd.send_command(0x3C)  # BorderWavefrom
+    epd.send_data(0x80)
 
-        if oldest_hour is None:
-            return None, None
+    epd.send_command(0x01)  # Driver output control
+    epd.send_data(0xF9)
+    epd.send_data(0x00)
+    epd.send_data(0x00)
 
-        prev_stats = smart_stats_history[oldest_hour]
+    epd.send_command(0x11)  # Data entry mode: X increment, then Y
+    epd.send_data(0x03)
 
-        load_delta = current_stats.get('Load_Cycle_Count', 0) - prev_stats.get('Load_Cycle_Count', 0)
-        start_delta = current_stats.get('Start_Stop_Count', 0) - prev_stats.get('Start_Stop_Count', 0)
+    epd.SetWindow(x0 * 8, y0, x1 * 8, y1)
+    epd.SetCursor(x0, y0)  # X address counter is in bytes
 
-        logger.debug(f"Delta calculation: current_hour={current_hour}, oldest_hour={oldest_hour}, "
-                     f"load_delta={load_delta}, start_delta={start_delta}")
+    rows = [buffer[y * line_bytes + x0:y * line_bytes + x1 + 1] for y in range(y0, y1 + 1)]
+    epd.send_command(0x24)  # WRITE_RAM
+    if FAST_SPI:
+        # Whole window in a single SPI transaction
+        epd.send_data2(b''.join(rows))
+    else:
+        for row in rows:
+            epd.send_data2(row)
+    epd.TurnOnDisplayPart()
 
-        return load_delta, start_delta
-    except Exception as e:
-        logger.error(f"Error calculating deltas: {e}")
-        return None, None
 
+def display_partial_changed(epd, buffer):
+    """Partial update that only transmits the rectangle changed since the last frame"""
+    global _partial_count
+    _partial_count += 1
+    if _prev_buffer is None or _partial_count % WINDOW_FULL_EVERY == 0:
+        epd.displayPartial(buffer)
+        return
+
+    window = _changed_window(epd, buffer, _prev_buffer)
+    if window is None:
+        logger.debug("Frame unchanged, skipping panel update")
+        return
 
-def render_display(epd, font18, font36, use_partial=True, set_base=False):
+    logger.debug(f"Partial window update: {window}")
+    _display_window(epd, buffer, *window)
+
+
+def _draw_field(key, box, xy, text, font):
+    """Redraw one text field on the canvas, skipping it if the text is what's already shown"""
+    if _last_text.get(key) == text:
+        return
+    # Draw over the static chrome for just this box, clipping glyphs to the field
+    field = _template.crop(box)
+    if text:
+        ImageDraw.Draw(field).text((xy[0] - box[0], xy[1] - box[1]), text, font=font, fill=0)
+    _canvas.paste(field, box)
+    _last_text[key] = text
+
+
+def show_buffer(epd, buffer, use_partial=True, set_base=False):
+    """Push a packed framebuffer to the panel (blocks until the refresh finishes)"""
+    global _prev_buffer
+    if set_base:
+        # Set base image for partial updates (writes to both RAM buffers)
+        epd.displayPartBaseImage(buffer)
+    elif use_partial:
+        display_partial_changed(epd, buffer)
+        _prev_buffer = buffer
+        return
+    else:
+        epd.display(buffer)
+    # The controller is re-initialised around base/full refreshes, so the next
+    # partial update sends the whole frame rather than trusting panel RAM
+    _prev_buffer = None
+
+
+async def render_display(epd, font18, font36, use_partial=True, set_base=False):
     """Render the display with current stats"""
+    # Start smartctl (if the cache needs refreshing) and let it run while we read local stats
+    smart_task = asyncio.create_task(get_smart_stats_cached())
+    await asyncio.sleep(0)
+
     # Get current data
     current_time = time.strftime('%-I:%M')  # H:MM format 12-hour (no leading zero on hour)
     current_date = time.strftime('%a %b %d')  # Day-of-week + date
@@ -211,109 +188,120 @@ def render_display(epd, font18, font36, use_partial=True, set_base=False):
     cpu_temp = get_cpu_temperature()
     days, hours = get_uptime()
     disk_usage = get_disk_usage()
-    smart_stats = get_smart_stats()
+
+    smart_stats, smart_current = await smart_task
 
     # Calculate deltas and update history
-    current_hour = datetime.now().hour
+    current_hour = time.localtime().tm_hour
     load_delta, start_delta = calculate_deltas(smart_stats, current_hour)
 
-    # Update history with current stats (overwrites data from 24 hours ago)
-    if smart_stats:
+    # Update history only with stats known to be current (overwrites data from 24 hours ago)
+    if smart_stats and smart_current:
         update_smart_history(smart_stats, current_hour)
 
-    # Create image
-    image = Image.new('1', (epd.height, epd.width), 255)
-    draw = ImageDraw.Draw(image)
+    # Full refreshes start over from the static chrome; partial ones only touch changed fields
+    global _canvas
+    if set_base or not use_partial or _canvas is None:
+        _canvas = _template.copy()
+        _last_text.clear()
+    image = _canvas
 
     # Left side - Time, Date, and System Stats
-    y_pos = 0
-
-    # Clear and draw time (fixed width: 5 chars "HH:MM")
-    draw.rectangle([(1, y_pos + 1), (119, y_pos + 36)], fill=255)
-    draw.text((4, y_pos + 1), current_time, font=font36, fill=0)
-    y_pos += 38
-
-    # Clear and draw date
-    draw.rectangle([(1, y_pos), (119, y_pos + 17)], fill=255)
-    draw.text((7, y_pos), current_date, font=font18, fill=0)
-   
-    # Draw box around time and date
-    draw.rectangle([(0, 0), (100, 59)], outline=0, width=1)
-    y_pos += 22
+    # Draw time (fixed width: 5 chars "HH:MM")
+    _draw_field('time', (0, 0, 125, 38), (4, 1), current_time, font36)
 
-    # Clear and draw load
-    draw.rectangle([(0, y_pos+1), (120, y_pos + 18)], fill=255)
-    draw.text((0, y_pos), f"{loads[0]:.1f} {loads[1]:.1f} {loads[2]:.1f}", font=font18, fill=0)
-    y_pos += 20
+    # Draw date
+    _draw_field('date', (0, 38, 125, 60), (7, 38), current_date, font18)
 
-    # Clear and draw mem/cpu (fixed width formatting)
-    draw.rectangle([(0, y_pos), (120, y_pos + 18)], fill=255)
-    draw.text((0, y_pos), f"M:{mem_percent:3.0f}% C:{cpu_temp:2.0f}C", font=font18, fill=0)
-    y_pos += 20
+    # Draw load
+    _draw_field('load', (0, 60, 125, 80), (0, 60),
+                f"{loads[0]:.1f} {loads[1]:.1f} {loads[2]:.1f}", font18)
 
-    # Clear and draw uptime (fixed width: "Up:XXXd XXh")
-    draw.rectangle([(0, y_pos), (120, y_pos + 18)], fill=255)
-    draw.text((0, y_pos), f"Up:{days:3d}d {hours:2d}h", font=font18, fill=0)
+    # Draw mem/cpu (fixed width formatting)
+    _draw_field('mem_cpu', (0, 80, 125, 100), (0, 80),
+                f"M:{mem_percent:3.0f}% C:{cpu_temp:2.0f}C", font18)
 
-    # Right side - Disk usage and SMART stats
-    y_pos = 0
-
-    # Disk usage on right side
-    draw.rectangle([(125, y_pos), (250, y_pos + 18)], fill=255)
-    if '/' in disk_usage:
-        draw.text((125, y_pos), f"/:        {disk_usage['/']:3d}%", font=font18, fill=0)
-    y_pos += 20
+    # Draw uptime (fixed width: "Up:XXXd XXh")
+    _draw_field('up', (0, 100, 125, 122), (0, 100), f"Up:{days:3d}d {hours:2d}h", font18)
 
-    draw.rectangle([(125, y_pos), (250, y_pos + 18)], fill=255)
-    if '/dev/sda1' in disk_usage:
-        draw.text((125, y_pos), f"sda1: {disk_usage['/dev/sda1']:3d}%", font=font18, fill=0)
-    y_pos += 20
+    # Right side - Disk usage and SMART stats, one 20px row each
+    rows = []
 
-    draw.rectangle([(125, y_pos), (250, y_pos + 18)], fill=255)
-    if '/dev/sdb1' in disk_usage:
-        draw.text((125, y_pos), f"sdb1: {disk_usage['/dev/sdb1']:3d}%", font=font18, fill=0)
-    y_pos += 20
+    # Disk usage on right side
+    rows.append(f"/:        {disk_usage['/']:3d}%" if '/' in disk_usage else "")
+    rows.append(f"sda1: {disk_usage['/dev/sda1']:3d}%" if '/dev/sda1' in disk_usage else "")
+    rows.append(f"sdb1: {disk_usage['/dev/sdb1']:3d}%" if '/dev/sdb1' in disk_usage else "")
 
     # SMART stats
     if smart_stats:
-        # Clear and draw Load Cycle delta (fixed width)
-        draw.rectangle([(125, y_pos), (250, y_pos + 18)], fill=255)
-        if load_delta is not None:
-            draw.text((125, y_pos), f"LdCyc: {load_delta}", font=font18, fill=0)
-        else:
-            draw.text((125, y_pos), "LdCyc: --", font=font18, fill=0)
-        y_pos += 20
-
-        # Clear and draw Start/Stop delta (fixed width)
-        draw.rectangle([(125, y_pos), (250, y_pos + 18)], fill=255)
-        if start_delta is not None:
-            draw.text((125, y_pos), f"StStp:  {start_delta}", font=font18, fill=0)
-        else:
-            draw.text((125, y_pos), "StStp: --", font=font18, fill=0)
-        y_pos += 20
+        # Load Cycle and Start/Stop deltas (fixed width)
+        rows.append(f"LdCyc: {load_delta}" if load_delta is not None else "LdCyc: --")
+        rows.append(f"StStp:  {start_delta}" if start_delta is not None else "StStp: --")
 
-        # Clear and draw health stats (all on one line)
-        draw.rectangle([(125, y_pos), (250, y_pos + 18)], fill=255)
+        # Health stats (all on one line)
         stats_line = f"Htlh: {smart_stats.get('Reallocated_Sector_Ct', 0)} "
         stats_line += f"{smart_stats.get('Current_Pending_Sector', 0)} "
         stats_line += f"{smart_stats.get('Offline_Uncorrectable', 0)} "
         stats_line += f"{smart_stats.get('UDMA_CRC_Error_Count', 0)}"
-        draw.text((125, y_pos), stats_line, font=font18, fill=0)
-    else:
-        draw.text((125, y_pos), "SMART N/A", font=font18, fill=0)
-
-    # Rotate image 180 degrees to flip top-to-bottom
-    image = image.rotate(180)
-
-    # Display the image using partial or full update
-    buffer = epd.getbuffer(image)
-    if set_base:
-        # Set base image for partial updates (writes to both RAM buffers)
-        epd.displayPartBaseImage(buffer)
-    elif use_partial:
-        epd.displayPartial(buffer)
+        rows.append(stats_line)
     else:
-        epd.display(buffer)
+        rows += ["SMART N/A", "", ""]
+
+    for i, text in enumerate(rows):
+        y_pos = i * 20
+        _draw_field(f"right{i}", (125, y_pos, 250, y_pos + 20),
+                    (125, y_pos), text, font18)
+
+    # Approximate ghosting: black pixels that went white since the last full refresh
+    global _erased_pixels, _prev_black_count
+    black_count = image.histogram()[0]
+    if set_base or not use_partial:
+        _erased_pixels = 0
+    elif _prev_black_count is not None:
+        _erased_pixels += max(0, _prev_black_count - black_count)
+    _prev_black_count = black_count
+
+    # Display the image using partial or full update, off the event loop
+    buffer = pack_buffer(epd, image)
+    await asyncio.to_thread(show_buffer, epd, buffer, use_partial, set_base)
+
+
+async def run_monitor(epd):
+    """Clear the panel, then update it every minute with partial refresh"""
+    # Initial full clear
+    logger.info("Performing initial full clear...")
+    epd.init()
+    epd.Clear(0xFF)
+    await asyncio.sleep(1)
+
+    open_pinned_files()
+
+    # Load fonts
+    font18 = ImageFont.truetype(os.path.join(picdir, 'Font.ttc'), 18)
+    font36 = ImageFont.truetype(os.path.join(picdir, 'Font.ttc'), 36)
+    build_template(epd)
+
+    # Set base image for partial updates
+    logger.info("Setting base image for partial updates...")
+    await render_display(epd, font18, font36, use_partial=False, set_base=True)
+
+    logger.info("Starting monitoring loop with partial updates (Ctrl+C to exit)...")
+
+    while True:
+        # Sleep until just past the top of the next minute for accurate clock sync
+        now = time.time()
+        next_minute = (int(now) // 60 + 1) * 60
+        await asyncio.sleep(max(0, next_minute - now + 0.05))
+
+        # Full refresh to clear ghosting once enough black pixels have been erased
+        if _erased_pixels > EINK_PARTIAL_ERASURE_LIMIT:
+            logger.info(f"Performing full refresh after {_erased_pixels} erased pixels...")
+            epd.init()
+            await render_display(epd, font18, font36, use_partial=False)
+            epd.init_fast()
+        else:
+            # Partial update
+            await render_display(epd, font18, font36, use_partial=True)
 
 
 def main():
@@ -321,43 +309,7 @@ def main():
     try:
         logger.info("Initializing e-Paper display...")
         epd = epd2in13_V4.EPD()
-
-        # Initial full clear
-        logger.info("Performing initial full clear...")
-        epd.init()
-        epd.Clear(0xFF)
-        time.sleep(1)
-
-        # Load fonts
-        font18 = ImageFont.truetype(os.path.join(picdir, 'Font.ttc'), 18)
-        font36 = ImageFont.truetype(os.path.join(picdir, 'Font.ttc'), 36)
-
-        # Set base image for partial updates
-        logger.info("Setting base image for partial updates...")
-        render_display(epd, font18, font36, use_partial=False, set_base=True)
-        time.sleep(2)
-
-        logger.info("Starting monitoring loop with partial updates (Ctrl+C to exit)...")
-
-        update_count = 0
-        while True:
-            # Sleep until the top of the next minute for accurate clock sync
-            now = time.time()
-            seconds_into_minute = now % 60
-            sleep_time = 60 - seconds_into_minute
-            time.sleep(sleep_time+1)
-
-            # Every 60 updates (1 hour), do a full refresh to clear ghosting
-            if update_count % 60 == 0 and update_count > 0:
-                logger.info("Performing periodic full refresh...")
-                epd.init()
-                render_display(epd, font18, font36, use_partial=False)
-                epd.init_fast()
-            else:
-                # Partial update
-                render_display(epd, font18, font36, use_partial=True)
-
-            update_count += 1
+        asyncio.run(run_monitor(epd))
 
     except KeyboardInterrupt:
         logger.info("Shutting down...")
@@ -365,6 +317,7 @@ def main():
         epd.Clear(0xFF)
         epd.sleep()
         epdconfig.module_exit(cleanup=True)
+        close_pinned_files()
 
     except Exception as e:
         logger.error(f"Error: {e}")